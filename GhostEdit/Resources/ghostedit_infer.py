@@ -6,7 +6,10 @@ JSON stdin/stdout protocol for model inference, downloading, and package checkin
 Launched as a subprocess by LocalModelRunner.swift.
 
 Commands:
-  - infer: Run inference on text using a local model
+  - infer: Run inference on text using a local model. With "stream": true,
+    partial output is written to stderr as {"partial": ...} lines while the
+    final response is still written to stdout. "no_repeat_ngram_size": n
+    blocks the model from repeating any n-gram of its own output.
   - download: Download a model from Hugging Face Hub
   - check_packages: Check which required Python packages are installed
   - check_hf_login: Check HuggingFace login status
@@ -16,52 +19,501 @@ Commands:
 Modes:
   - One-shot (default): Reads single JSON from stdin, writes response to stdout.
   - Serve (--serve): Persistent process reading line-delimited JSON from stdin,
-    caching model in memory between requests.
+    caching the most recently used models in memory between requests.
+    Pass --preload <model_path> to load a model before the first request, and
+    --compile to compile loaded models with torch.compile.
 """
 
+import gc
+import importlib.util
 import json
+import select
+import stat
+import subprocess
 import sys
+import threading
 import time
 import os
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# transformers is imported on first use -- it takes seconds to initialize and
+# commands like check_packages never need it
+_tf = None
+
+
+def _transformers():
+    """Return the transformers module, importing it once on first use."""
+    global _tf
+    if _tf is None:
+        import transformers
+        _tf = transformers
+    return _tf
+
+
+def _physical_core_count():
+    """Best-effort count of physical (performance) cores for inference threads."""
+    if sys.platform == "darwin":
+        # Apple Silicon: performance cores only; Intel Macs lack perflevel0
+        for key in ["hw.perflevel0.physicalcpu", "hw.physicalcpu"]:
+            try:
+                output = subprocess.run(
+                    ["/usr/sbin/sysctl", "-n", key], capture_output=True, text=True, timeout=2
+                ).stdout.strip()
+            except Exception:
+                continue
+            if output.isdigit() and int(output) > 0:
+                return int(output)
+    # Assume two hardware threads per physical core elsewhere
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+def _configure_cpu_threads():
+    """Size the OpenMP/MKL thread pools before torch is imported.
+
+    Values already set in the environment are left untouched.
+    """
+    cores = str(_physical_core_count())
+    os.environ.setdefault("OMP_NUM_THREADS", cores)
+    os.environ.setdefault("MKL_NUM_THREADS", cores)
+
+
+def _configure_torch_threads(torch):
+    """Match torch's intra-op pool to OMP_NUM_THREADS and use a single inter-op thread."""
+    try:
+        torch.set_num_threads(int(os.environ.get("OMP_NUM_THREADS", "0")) or _physical_core_count())
+    except (RuntimeError, ValueError):
+        pass
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set once, before any inter-op work has started
+        pass
+
+
+# Standard huggingface-cli location first, then the legacy path
+HF_TOKEN_PATHS = ["~/.cache/huggingface/token", "~/.huggingface/token"]
+
+# Last token read from HF_TOKEN_PATHS, keyed by the files' (mtime, size)
+_token_cache = {"signature": None, "token": None}
+
+
+def _token_file_signature():
+    """Return (mtime_ns, size) per token path, or None where no regular file exists."""
+    signature = []
+    for path in HF_TOKEN_PATHS:
+        try:
+            info = os.stat(os.path.expanduser(path))
+        except OSError:
+            signature.append(None)
+            continue
+        signature.append((info.st_mtime_ns, info.st_size) if stat.S_ISREG(info.st_mode) else None)
+    return tuple(signature)
+
+
+def _resolve_token():
+    """Return (token, source) from the HF_TOKEN env var or a token file.
+
+    source is "env", "file" or "none". Token files are only re-read when one
+    of them is created, removed or modified.
+    """
+    env_token = os.environ.get("HF_TOKEN", "")
+    if env_token:
+        return env_token, "env"
+
+    signature = _token_file_signature()
+    if signature != _token_cache["signature"]:
+        token = None
+        for path, file_signature in zip(HF_TOKEN_PATHS, signature):
+            if file_signature is None:
+                continue
+            with open(os.path.expanduser(path)) as f:
+                contents = f.read().strip()
+            if contents:
+                token = contents
+                break
+        _token_cache["signature"] = signature
+        _token_cache["token"] = token
+
+    if _token_cache["token"]:
+        return _token_cache["token"], "file"
+    return None, "none"
 
 
 def _get_hf_token():
     """Read the HuggingFace token from env var or token file."""
-    token = os.environ.get("HF_TOKEN", "")
-    if token:
-        return token
-    # Check both the standard huggingface-cli location and the legacy path
-    for path in ["~/.cache/huggingface/token", "~/.huggingface/token"]:
-        expanded = os.path.expanduser(path)
-        if os.path.isfile(expanded):
-            with open(expanded) as f:
-                token = f.read().strip()
-            if token:
-                return token
-    return None
+    return _resolve_token()[0]
 
 
-def _detect_model_type(model_path):
-    """Read the saved model type marker, defaulting to seq2seq."""
+def _read_model_marker(model_path):
+    """Read the ghostedit_model_type.json marker written at download time."""
     marker = os.path.join(model_path, "ghostedit_model_type.json")
     if os.path.isfile(marker):
         try:
             with open(marker) as f:
-                return json.load(f).get("type", "seq2seq")
+                data = json.load(f)
+            if isinstance(data, dict):
+                return data
         except Exception:
             pass
+    return {}
+
+
+def _read_model_config(config_dir):
+    """Load config.json from a model directory. Raises if missing or unreadable."""
+    with open(os.path.join(config_dir, "config.json")) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError("config.json is not a JSON object")
+    return config
+
+
+def _config_to_type(config):
+    """Map a parsed config.json to "seq2seq" or "causal"."""
+    # Checked first so legacy configs like T5WithLMHeadModel stay seq2seq
+    if config.get("is_encoder_decoder"):
+        return "seq2seq"
+    architectures = config.get("architectures") or [""]
+    if "CausalLM" in architectures[0] or "LMHead" in architectures[0]:
+        return "causal"
     return "seq2seq"
 
 
-def _load_model(model_path):
-    """Load the correct model class based on the model type marker."""
-    model_type = _detect_model_type(model_path)
+def _arch_to_type(config_dir):
+    """Infer seq2seq vs causal from config.json, defaulting to seq2seq if it is unreadable."""
+    try:
+        return _config_to_type(_read_model_config(config_dir))
+    except Exception:
+        return "seq2seq"
+
+
+def _detect_model_type(model_path, marker=None):
+    """Read the saved model type marker, falling back to config.json."""
+    if marker is None:
+        marker = _read_model_marker(model_path)
+    return marker.get("type") or _arch_to_type(model_path)
+
+
+def _quantize_model(model):
+    """Apply INT8 dynamic quantization to Linear layers. Returns the original model on failure."""
+    try:
+        import torch
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    except Exception:
+        return model
+
+
+ONNX_SUBDIR = "onnx"
+
+
+def _onnx_model_dir(model_path):
+    """Return the ONNX export directory if it contains exported graphs, else None."""
+    onnx_dir = os.path.join(model_path, ONNX_SUBDIR)
+    if os.path.isdir(onnx_dir) and any(name.endswith(".onnx") for name in os.listdir(onnx_dir)):
+        return onnx_dir
+    return None
+
+
+def _ort_model_class(model_type):
+    """Return the optimum ONNX Runtime class matching the model type."""
     if model_type == "causal":
-        from transformers import AutoModelForCausalLM
-        return AutoModelForCausalLM.from_pretrained(model_path), model_type
+        from optimum.onnxruntime import ORTModelForCausalLM
+        return ORTModelForCausalLM
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    return ORTModelForSeq2SeqLM
+
+
+def _export_onnx(model_path, model_type):
+    """Export a downloaded model to ONNX and INT8-quantize the graphs in place.
+
+    Requires optimum[onnxruntime]. A failed export is removed so that
+    _load_model never picks up a partial graph.
+    """
+    import shutil
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    onnx_dir = os.path.join(model_path, ONNX_SUBDIR)
+    try:
+        ort_model = _ort_model_class(model_type).from_pretrained(
+            model_path, export=True, provider="CPUExecutionProvider"
+        )
+        ort_model.save_pretrained(onnx_dir)
+
+        for name in os.listdir(onnx_dir):
+            if not name.endswith(".onnx"):
+                continue
+            graph_path = os.path.join(onnx_dir, name)
+            quantized_path = graph_path + ".quant"
+            quantize_dynamic(graph_path, quantized_path, weight_type=QuantType.QInt8)
+            os.replace(quantized_path, graph_path)
+    except Exception:
+        shutil.rmtree(onnx_dir, ignore_errors=True)
+        raise
+
+
+# T5-family activations overflow float16 and produce NaNs/garbage output
+FP16_UNSAFE_MODEL_TYPES = ("t5", "mt5", "umt5", "longt5", "switch_transformers")
+
+
+def _is_fp16_unsafe(model_path):
+    """Return True if config.json describes a T5-family model."""
+    try:
+        config = _read_model_config(model_path)
+    except Exception:
+        return False
+    if config.get("model_type") in FP16_UNSAFE_MODEL_TYPES:
+        return True
+    architectures = config.get("architectures") or [""]
+    return architectures[0].startswith(("T5", "MT5", "UMT5", "LongT5"))
+
+
+def _preferred_dtype_name(device, model_path=None):
+    """Pick the lowest-precision float dtype the given device runs efficiently.
+
+    float16 on Metal or CUDA (float32 for T5-family models, which overflow in
+    float16), bfloat16 on x86 CPUs with AVX512-BF16, float32 everywhere else.
+    """
+    import platform
+    import torch
+
+    if device in ("mps", "cuda"):
+        if model_path and _is_fp16_unsafe(model_path):
+            return "float32"
+        return "float16"
+    machine = platform.machine().lower()
+    if machine in ("x86_64", "amd64"):
+        try:
+            if torch.cpu._is_avx512_bf16_supported():
+                return "bfloat16"
+        except AttributeError:
+            pass
+    return "float32"
+
+
+def _select_device():
+    """Return the torch device to run inference on: Metal, CUDA, or CPU."""
+    import torch
+
+    if torch.backends.mps.is_available():
+        return "mps"
+    if torch.cuda.is_available():
+        return "cuda"
+    return "cpu"
+
+
+def _from_pretrained_fused(model_cls, model_path, **kwargs):
+    """Load a model with fused scaled-dot-product attention where supported.
+
+    Tries attn_implementation="sdpa" first; architectures or transformers
+    versions that reject it are loaded with stock attention and, if optimum is
+    installed, converted with BetterTransformer instead.
+    """
+    try:
+        return model_cls.from_pretrained(model_path, attn_implementation="sdpa", **kwargs)
+    except (TypeError, ValueError, ImportError):
+        pass
+
+    model = model_cls.from_pretrained(model_path, **kwargs)
+    try:
+        from optimum.bettertransformer import BetterTransformer
+        model = BetterTransformer.transform(model, keep_original_model=False)
+    except Exception:
+        pass
+    return model
+
+
+def _ipex_optimize(model, torch_dtype):
+    """Apply Intel Extension for PyTorch CPU optimizations when it is installed."""
+    try:
+        import intel_extension_for_pytorch as ipex
+        return ipex.optimize(model, dtype=torch_dtype)
+    except Exception:
+        return model
+
+
+TRACED_ENCODER_FILE = "encoder_traced.pt"
+
+
+def _trace_encoder(model_path):
+    """Save a frozen TorchScript trace of a seq2seq model's encoder next to its weights.
+
+    The trace is checked against eager output on a longer, padded two-row batch
+    first (the shape serve-mode batching feeds it), since a trace that baked in
+    the example's batch size or sequence length would be silently wrong.
+    """
+    import torch
+
+    tf = _transformers()
+    tokenizer = tf.AutoTokenizer.from_pretrained(model_path)
+    model = tf.AutoModelForSeq2SeqLM.from_pretrained(model_path, torch_dtype=torch.float32)
+    model.eval()
+
+    class EncoderHiddenStates(torch.nn.Module):
+        def __init__(self, encoder):
+            super().__init__()
+            self.encoder = encoder
+
+        def forward(self, input_ids, attention_mask):
+            return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+    wrapper = EncoderHiddenStates(model.get_encoder()).eval()
+    example = tokenizer("hello", return_tensors="pt")
+    check = tokenizer(
+        ["The quick brown fox jumps over the lazy dog, twice.", "Short one."],
+        return_tensors="pt",
+        padding=True,
+    )
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, (example["input_ids"], example["attention_mask"]), strict=False)
+        traced = torch.jit.freeze(traced)
+        expected = wrapper(check["input_ids"], check["attention_mask"])
+        actual = traced(check["input_ids"], check["attention_mask"])
+    if actual.shape != expected.shape or not torch.allclose(actual, expected, atol=1e-4):
+        raise RuntimeError("traced encoder does not match eager output")
+    torch.jit.save(traced, os.path.join(model_path, TRACED_ENCODER_FILE))
+
+
+def _use_traced_encoder(model, model_path):
+    """Swap a seq2seq model's encoder for the saved TorchScript trace, if present.
+
+    Only used for unquantized FP32 models on CPU (quantize=false); the trace is
+    written at download when the request sets "trace_encoder": true.
+    """
+    path = os.path.join(model_path, TRACED_ENCODER_FILE)
+    if not os.path.isfile(path):
+        return model
+
+    try:
+        import torch
+        from transformers.modeling_outputs import BaseModelOutput
+
+        traced = torch.jit.load(path, map_location="cpu")
+    except Exception:
+        return model
+
+    class TracedEncoder(torch.nn.Module):
+        main_input_name = "input_ids"
+
+        def __init__(self, traced):
+            super().__init__()
+            self.traced = traced
+
+        def forward(self, input_ids=None, attention_mask=None, **kwargs):
+            if attention_mask is None:
+                attention_mask = torch.ones_like(input_ids)
+            return BaseModelOutput(last_hidden_state=self.traced(input_ids, attention_mask))
+
+    original = model.get_encoder()
+    encoder = TracedEncoder(traced)
+    model.get_encoder = lambda: encoder
+    # Drop the eager encoder's weights when the model holds it directly (T5)
+    if getattr(model, "encoder", None) is original:
+        model.encoder = encoder
+    return model
+
+
+def _nf4_config(torch):
+    """Build a 4-bit NF4 BitsAndBytesConfig, or None when bitsandbytes is not installed."""
+    if not _is_installed("bitsandbytes"):
+        return None
+    compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return _transformers().BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_compute_dtype=compute_dtype,
+        bnb_4bit_quant_type="nf4",
+    )
+
+
+def _quantization_mode(marker, model_type, device, quantize):
+    """Return how _load_model quantizes: "nf4", "int8", or None when quantize has no effect."""
+    if not quantize:
+        return None
+    # bitsandbytes 4-bit kernels need CUDA; elsewhere fall through to the regular path
+    if model_type == "causal" and marker.get("quant") == "nf4" and device == "cuda":
+        return "nf4"
+    # INT8 dynamic quantization and the ONNX Runtime export are CPU-only
+    if marker.get("quantized", True) and device == "cpu":
+        return "int8"
+    return None
+
+
+def _load_model(model_path, quantize=True):
+    """Load the correct model class based on the model type marker.
+
+    Models run on the Metal or CUDA device when one is available. With
+    quantize set, CPU models use the INT8 ONNX export if one exists and
+    otherwise INT8 dynamic quantization of their Linear layers, unless the
+    marker opts out with "quantized": false.
+
+    On CUDA, causal models whose marker has "quant": "nf4" (written when the
+    download request asks for it) load with 4-bit bitsandbytes weights. NF4 is
+    not the default even when bitsandbytes is installed: for the small editing
+    models GhostEdit runs, per-matmul dequantization makes single-sequence
+    decode slower than float16 and costs some accuracy, so it only pays off
+    when a larger model would not otherwise fit in GPU memory.
+    """
+    import torch
+
+    _configure_torch_threads(torch)
+    marker = _read_model_marker(model_path)
+    model_type = _detect_model_type(model_path, marker)
+    device = _select_device()
+    mode = _quantization_mode(marker, model_type, device, quantize)
+    quantize = mode == "int8"
+
+    onnx_dir = _onnx_model_dir(model_path) if quantize else None
+    if onnx_dir:
+        try:
+            ort_model = _ort_model_class(model_type).from_pretrained(
+                onnx_dir, provider="CPUExecutionProvider"
+            )
+            return ort_model, model_type
+        except Exception:
+            pass
+
+    # INT8 dynamic quantization needs FP32 weights, so the reduced-precision
+    # dtype only applies to models that are not quantized. The marker's dtype
+    # was chosen for the device seen at download and only applies to that device
+    if quantize:
+        dtype_name = "float32"
+    elif marker.get("dtype") and marker.get("device") == device:
+        dtype_name = marker["dtype"]
+    else:
+        dtype_name = _preferred_dtype_name(device, model_path)
+    torch_dtype = getattr(torch, dtype_name, torch.float32)
+
+    tf = _transformers()
+    model_cls = tf.AutoModelForCausalLM if model_type == "causal" else tf.AutoModelForSeq2SeqLM
+
+    if mode == "nf4":
+        nf4_config = _nf4_config(torch)
+        if nf4_config is not None:
+            try:
+                model = _from_pretrained_fused(
+                    model_cls, model_path, quantization_config=nf4_config, device_map=device
+                )
+                model.eval()
+                return model, model_type
+            except Exception:
+                pass
+
+    model = _from_pretrained_fused(model_cls, model_path, torch_dtype=torch_dtype)
+    model.eval()
+    if quantize:
+        model = _quantize_model(model)
+    elif device != "cpu":
+        model = model.to(device)
     else:
-        from transformers import AutoModelForSeq2SeqLM
-        return AutoModelForSeq2SeqLM.from_pretrained(model_path), model_type
+        model = _ipex_optimize(model, torch_dtype)
+    # The trace was recorded from the unquantized FP32 encoder on CPU, so it
+    # would silently undo INT8 quantization anywhere else
+    if not quantize and model_type == "seq2seq" and device == "cpu" and torch_dtype == torch.float32:
+        model = _use_traced_encoder(model, model_path)
+    return model, model_type
 
 
 def _render_prompt(prompt_template, text):
@@ -74,35 +526,263 @@ def _render_prompt(prompt_template, text):
     return text
 
 
-def _run_inference(tokenizer, model, model_type, text, max_length, prompt_template):
+def _banned_ngram_tokens(input_ids, start, n, rows, tokens):
+    """Find tokens that would complete an n-gram already present after position start.
+
+    input_ids is a (batch, length) int64 array. Matches are written to the
+    rows/tokens arrays (capacity batch * length) and their count is returned.
+    Kept numba-compatible so _ngram_kernel can JIT-compile it.
+    """
+    batch, length = input_ids.shape
+    prefix_start = length - n + 1
+    if n < 1 or prefix_start < start:
+        return 0
+
+    count = 0
+    for b in range(batch):
+        for i in range(start, length - n + 1):
+            match = True
+            for k in range(n - 1):
+                if input_ids[b, i + k] != input_ids[b, prefix_start + k]:
+                    match = False
+                    break
+            if match:
+                rows[count] = b
+                tokens[count] = input_ids[b, i + n - 1]
+                count += 1
+    return count
+
+
+_ngram_kernel_fn = None
+
+
+def _ngram_kernel():
+    """Return _banned_ngram_tokens, JIT-compiled with numba when it is installed.
+
+    The compiled kernel is cached on disk under ~/.cache/ghostedit/numba so
+    later processes skip compilation.
+    """
+    global _ngram_kernel_fn
+    if _ngram_kernel_fn is None:
+        os.environ.setdefault("NUMBA_CACHE_DIR", os.path.expanduser("~/.cache/ghostedit/numba"))
+        try:
+            import numba
+            _ngram_kernel_fn = numba.njit(cache=True)(_banned_ngram_tokens)
+        except ImportError:
+            _ngram_kernel_fn = _banned_ngram_tokens
+    return _ngram_kernel_fn
+
+
+class NjitNoRepeatNGramProcessor:
+    """Logits processor that blocks repeating any n-gram of the generated text.
+
+    Unlike transformers' NoRepeatNGramLogitsProcessor the prompt is excluded,
+    so a causal model can still copy the text it is correcting.
+    """
+
+    def __init__(self, ngram_size, prompt_length):
+        self.ngram_size = ngram_size
+        self.prompt_length = prompt_length
+        self.kernel = _ngram_kernel()
+
+    def __call__(self, input_ids, scores):
+        import numpy as np
+        import torch
+
+        ids = input_ids.detach().cpu().numpy()
+        capacity = ids.shape[0] * ids.shape[1]
+        rows = np.empty(capacity, dtype=np.int64)
+        tokens = np.empty(capacity, dtype=np.int64)
+        count = self.kernel(ids, self.prompt_length, self.ngram_size, rows, tokens)
+        if count:
+            scores[
+                torch.as_tensor(rows[:count], device=scores.device),
+                torch.as_tensor(tokens[:count], device=scores.device),
+            ] = -float("inf")
+        return scores
+
+
+def _generation_kwargs(tokenizer, no_repeat_ngram_size=0, prompt_length=0):
+    """Greedy decoding with the KV cache, shared by both model types.
+
+    eos_token_id is left to the model's generation_config, which for chat
+    models lists several stop tokens (e.g. Gemma's <end_of_turn>).
+    A positive no_repeat_ngram_size adds NjitNoRepeatNGramProcessor, applied to
+    tokens after prompt_length.
+    """
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+    kwargs = {
+        "use_cache": True,
+        "num_beams": 1,
+        "do_sample": False,
+        "pad_token_id": pad_token_id,
+    }
+    if no_repeat_ngram_size > 0:
+        kwargs["logits_processor"] = _transformers().LogitsProcessorList(
+            [NjitNoRepeatNGramProcessor(no_repeat_ngram_size, prompt_length)]
+        )
+    return kwargs
+
+
+MAX_INPUT_TOKENS = 512
+
+
+def _make_input_buffers():
+    """Allocate reusable (1, MAX_INPUT_TOKENS) input_ids/attention_mask tensors for serve mode."""
+    import torch
+
+    input_ids = torch.zeros((1, MAX_INPUT_TOKENS), dtype=torch.long)
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+
+def _encode_prompt(tokenizer, prompt, device, buffers=None):
+    """Tokenize a single prompt into model inputs on device.
+
+    Uses tokenizer.encode() for just the ids and builds the all-ones attention
+    mask directly. With buffers, the ids are copied into the pre-allocated
+    tensors and views of the used prefix are returned instead of allocating
+    new ones.
+    """
+    import torch
+
+    ids = tokenizer.encode(prompt, add_special_tokens=True, max_length=MAX_INPUT_TOKENS, truncation=True)
+    length = len(ids)
+    if buffers is None:
+        input_ids = torch.tensor([ids], dtype=torch.long)
+        return {
+            "input_ids": input_ids.to(device),
+            "attention_mask": torch.ones_like(input_ids).to(device),
+        }
+
+    buffers["input_ids"][0, :length] = torch.as_tensor(ids, dtype=torch.long)
+    return {
+        "input_ids": buffers["input_ids"][:, :length].to(device),
+        "attention_mask": buffers["attention_mask"][:, :length].to(device),
+    }
+
+
+def _generate(model, tokenizer, inputs, stream=False, **kwargs):
+    """Call model.generate(), optionally streaming partial text to stderr.
+
+    When streaming, generation runs on a worker thread while the decoded text
+    is written as {"partial": ...} JSON lines, like download progress events.
+    The full output tensor is returned either way.
+    """
+    if not stream:
+        return model.generate(**inputs, **kwargs)
+
+    streamer = _transformers().TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    result = {}
+
+    def run():
+        try:
+            result["outputs"] = model.generate(**inputs, streamer=streamer, **kwargs)
+        except Exception as e:
+            result["error"] = e
+            # Unblock the iterator on the main thread
+            streamer.end()
+
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+    for chunk in streamer:
+        if chunk:
+            print(json.dumps({"partial": chunk}), file=sys.stderr, flush=True)
+    worker.join()
+
+    if "error" in result:
+        raise result["error"]
+    return result["outputs"]
+
+
+def _run_inference(
+    tokenizer, model, model_type, text, max_length, prompt_template,
+    buffers=None, stream=False, no_repeat_ngram_size=0,
+):
     """Run inference with the appropriate strategy for the model type."""
     rendered_prompt = _render_prompt(prompt_template, text)
     if model_type == "causal":
         # For causal LMs, use chat-style or text-generation approach
-        inputs = tokenizer(rendered_prompt, return_tensors="pt", max_length=512, truncation=True)
+        inputs = _encode_prompt(tokenizer, rendered_prompt, model.device, buffers)
         input_length = inputs["input_ids"].shape[1]
-        outputs = model.generate(
-            **inputs,
+        outputs = _generate(
+            model,
+            tokenizer,
+            inputs,
+            stream,
             max_new_tokens=max_length,
-            do_sample=False,
-            pad_token_id=tokenizer.eos_token_id,
+            **_generation_kwargs(tokenizer, no_repeat_ngram_size, input_length),
         )
         # Only decode the newly generated tokens (after the prompt)
         corrected = tokenizer.decode(outputs[0][input_length:], skip_special_tokens=True).strip()
     else:
         # Seq2seq: standard encode-decode
-        inputs = tokenizer(rendered_prompt, return_tensors="pt", max_length=512, truncation=True)
-        outputs = model.generate(**inputs, max_length=max_length)
+        inputs = _encode_prompt(tokenizer, rendered_prompt, model.device, buffers)
+        outputs = _generate(
+            model,
+            tokenizer,
+            inputs,
+            stream,
+            max_length=max_length,
+            **_generation_kwargs(tokenizer, no_repeat_ngram_size),
+        )
         corrected = tokenizer.decode(outputs[0], skip_special_tokens=True)
     return corrected
 
 
+def _tokenize_batch(tokenizer, prompts, device, padding_side):
+    """Tokenize prompts into one padded batch without leaving the tokenizer modified.
+
+    Tokenizers without a pad token (most causal LMs) pad with EOS for this call
+    only; pad_token and padding_side are restored afterwards, since the
+    tokenizer is shared with unbatched requests in serve mode.
+    """
+    pad_token = tokenizer.pad_token
+    original_side = tokenizer.padding_side
+    if pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = padding_side
+    try:
+        return tokenizer(
+            prompts, return_tensors="pt", padding=True, max_length=MAX_INPUT_TOKENS, truncation=True
+        ).to(device)
+    finally:
+        tokenizer.padding_side = original_side
+        if pad_token is None:
+            tokenizer.pad_token = None
+
+
+def _run_batch_inference(tokenizer, model, model_type, prompts, max_length, no_repeat_ngram_size=0):
+    """Run one padded generate() over several rendered prompts, returning outputs in order."""
+    if model_type == "causal":
+        # Decoder-only models continue from the last position, so pad on the left
+        inputs = _tokenize_batch(tokenizer, prompts, model.device, "left")
+        input_length = inputs["input_ids"].shape[1]
+        outputs = model.generate(
+            **inputs,
+            max_new_tokens=max_length,
+            **_generation_kwargs(tokenizer, no_repeat_ngram_size, input_length),
+        )
+        decoded = tokenizer.batch_decode(outputs[:, input_length:], skip_special_tokens=True)
+        return [text.strip() for text in decoded]
+
+    inputs = _tokenize_batch(tokenizer, prompts, model.device, tokenizer.padding_side)
+    outputs = model.generate(
+        **inputs, max_length=max_length, **_generation_kwargs(tokenizer, no_repeat_ngram_size)
+    )
+    return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+
+
 def cmd_infer(request):
     """Run inference using a local model (auto-detects seq2seq vs causal)."""
     model_path = request.get("model_path", "")
     text = request.get("text", "")
     max_length = request.get("max_length", 256)
     prompt_template = request.get("prompt_template", "{text}")
+    quantize = request.get("quantize", True)
+    stream = request.get("stream", False)
+    no_repeat_ngram_size = request.get("no_repeat_ngram_size", 0)
 
     if not model_path or not text:
         return {"status": "error", "message": "model_path and text are required"}
@@ -111,12 +791,13 @@ def cmd_infer(request):
         return {"status": "error", "message": f"Model directory not found: {model_path}"}
 
     try:
-        from transformers import AutoTokenizer
-
         start = time.time()
-        tokenizer = AutoTokenizer.from_pretrained(model_path)
-        model, model_type = _load_model(model_path)
-        corrected = _run_inference(tokenizer, model, model_type, text, max_length, prompt_template)
+        tokenizer = _transformers().AutoTokenizer.from_pretrained(model_path)
+        model, model_type = _load_model(model_path, quantize=quantize)
+        corrected = _run_inference(
+            tokenizer, model, model_type, text, max_length, prompt_template,
+            stream=stream, no_repeat_ngram_size=no_repeat_ngram_size,
+        )
         elapsed_ms = int((time.time() - start) * 1000)
 
         return {"status": "ok", "corrected": corrected, "elapsed_ms": elapsed_ms}
@@ -127,18 +808,23 @@ def cmd_infer(request):
         return {"status": "error", "message": str(e)}
 
 
-def cmd_infer_with_cache(request, tokenizer, model, model_type):
-    """Run inference using pre-loaded model and tokenizer."""
+def cmd_infer_with_cache(request, tokenizer, model, model_type, buffers=None):
+    """Run inference using pre-loaded model, tokenizer and optional input buffers."""
     text = request.get("text", "")
     max_length = request.get("max_length", 256)
     prompt_template = request.get("prompt_template", "{text}")
+    stream = request.get("stream", False)
+    no_repeat_ngram_size = request.get("no_repeat_ngram_size", 0)
 
     if not text:
         return {"status": "error", "message": "text is required"}
 
     try:
         start = time.time()
-        corrected = _run_inference(tokenizer, model, model_type, text, max_length, prompt_template)
+        corrected = _run_inference(
+            tokenizer, model, model_type, text, max_length, prompt_template,
+            buffers, stream, no_repeat_ngram_size,
+        )
         elapsed_ms = int((time.time() - start) * 1000)
 
         return {"status": "ok", "corrected": corrected, "elapsed_ms": elapsed_ms}
@@ -147,6 +833,87 @@ def cmd_infer_with_cache(request, tokenizer, model, model_type):
         return {"status": "error", "message": str(e)}
 
 
+def cmd_infer_batch_with_cache(requests, tokenizer, model, model_type, buffers=None):
+    """Run several infer requests sharing a model and generation settings as one batch.
+
+    Returns one response per request, in the same order.
+    """
+    results = [None] * len(requests)
+    batch = []
+    prompts = []
+    for index, request in enumerate(requests):
+        if not request.get("text", ""):
+            results[index] = {"status": "error", "message": "text is required"}
+            continue
+        # A malformed request fails on its own instead of taking down the batch
+        try:
+            prompts.append(_render_prompt(request.get("prompt_template", "{text}"), request["text"]))
+        except Exception as e:
+            results[index] = {"status": "error", "message": str(e)}
+            continue
+        batch.append(index)
+
+    if len(batch) == 1:
+        results[batch[0]] = cmd_infer_with_cache(requests[batch[0]], tokenizer, model, model_type, buffers)
+    elif batch:
+        max_length = requests[batch[0]].get("max_length", 256)
+        no_repeat_ngram_size = requests[batch[0]].get("no_repeat_ngram_size", 0)
+        try:
+            start = time.time()
+            outputs = _run_batch_inference(
+                tokenizer, model, model_type, prompts, max_length, no_repeat_ngram_size
+            )
+            elapsed_ms = int((time.time() - start) * 1000)
+            for index, corrected in zip(batch, outputs):
+                results[index] = {"status": "ok", "corrected": corrected, "elapsed_ms": elapsed_ms}
+        except Exception as e:
+            for index in batch:
+                results[index] = {"status": "error", "message": str(e)}
+    return results
+
+
+# Values huggingface_hub treats as true for boolean environment flags
+HF_ENV_TRUE_VALUES = ("1", "ON", "YES", "TRUE")
+
+
+def _enable_parallel_downloads():
+    """Use hf_transfer for Hub file downloads when it is installed.
+
+    Returns True if hf_transfer will be used. An explicit user setting is kept.
+    huggingface_hub reads the flag at import time, so it only takes effect
+    before the first import (downloads run as one-shot processes).
+    """
+    if importlib.util.find_spec("hf_transfer") is None or "huggingface_hub" in sys.modules:
+        return False
+    os.environ.setdefault("HF_HUB_ENABLE_HF_TRANSFER", "1")
+    return os.environ["HF_HUB_ENABLE_HF_TRANSFER"].upper() in HF_ENV_TRUE_VALUES
+
+
+# Weight files from_pretrained() reads, in order of preference. Only one format
+# is fetched; everything else (GGUF, TF/Flax, consolidated.* and original/*
+# checkpoints, upstream ONNX exports) is never downloaded
+DOWNLOAD_WEIGHT_FORMATS = [("model", ".safetensors"), ("pytorch_model", ".bin")]
+# Config, generation and tokenizer files (including sharded weight indexes)
+DOWNLOAD_SUPPORT_SUFFIXES = (".json", ".txt", ".model", ".tiktoken")
+DOWNLOAD_MAX_WORKERS = 8
+
+
+def _select_download_files(repo_files):
+    """Pick the top-level files from_pretrained() needs: configs, tokenizer and one weight format.
+
+    Returns None when the repo has neither safetensors nor PyTorch .bin weights.
+    """
+    top_level = [name for name in repo_files if "/" not in name]
+    for prefix, suffix in DOWNLOAD_WEIGHT_FORMATS:
+        weights = [name for name in top_level if name.startswith(prefix) and name.endswith(suffix)]
+        if weights:
+            break
+    else:
+        return None
+    support = [name for name in top_level if name.endswith(DOWNLOAD_SUPPORT_SUFFIXES)]
+    return support + weights
+
+
 def cmd_download(request):
     """Download a model from Hugging Face Hub (auto-detects seq2seq vs causal)."""
     repo_id = request.get("repo_id", "")
@@ -155,37 +922,81 @@ def cmd_download(request):
     if not repo_id or not dest_path:
         return {"status": "error", "message": "repo_id and dest_path are required"}
 
-    try:
-        from transformers import AutoTokenizer
+    def progress_callback(msg, pct):
+        print(json.dumps({"progress": pct, "message": msg}), file=sys.stderr, flush=True)
 
-        token = _get_hf_token()
+    if _enable_parallel_downloads():
+        progress_callback("Parallel downloads enabled (hf_transfer)", 5)
 
-        def progress_callback(msg, pct):
-            print(json.dumps({"progress": pct, "message": msg}), file=sys.stderr, flush=True)
+    try:
+        from huggingface_hub import HfApi, snapshot_download
 
-        progress_callback("Downloading tokenizer...", 10)
-        tokenizer = AutoTokenizer.from_pretrained(repo_id, token=token)
+        token = _get_hf_token()
 
-        progress_callback("Downloading model...", 30)
-        model_type = "seq2seq"
-        try:
-            from transformers import AutoModelForSeq2SeqLM
-            model = AutoModelForSeq2SeqLM.from_pretrained(repo_id, token=token)
-        except (ValueError, OSError):
-            from transformers import AutoModelForCausalLM
-            model = AutoModelForCausalLM.from_pretrained(repo_id, token=token)
-            model_type = "causal"
-
-        progress_callback("Saving tokenizer...", 70)
+        repo_files = HfApi().list_repo_files(repo_id, token=token)
+        if "config.json" not in repo_files:
+            return {
+                "status": "error",
+                "message": f"{repo_id} has no config.json and cannot be loaded with transformers",
+            }
+        files = _select_download_files(repo_files)
+        if files is None:
+            return {
+                "status": "error",
+                "message": f"{repo_id} has no safetensors or PyTorch weights to load with transformers",
+            }
+
+        # Files land directly in dest_path -- no load/save_pretrained round trip
+        progress_callback("Downloading model files...", 10)
         os.makedirs(dest_path, exist_ok=True)
-        tokenizer.save_pretrained(dest_path)
+        snapshot_download(
+            repo_id,
+            local_dir=dest_path,
+            token=token,
+            max_workers=DOWNLOAD_MAX_WORKERS,
+            allow_patterns=files,
+        )
 
-        progress_callback("Saving model...", 85)
-        model.save_pretrained(dest_path)
+        progress_callback("Detecting model type...", 80)
+        try:
+            model_type = _config_to_type(_read_model_config(dest_path))
+        except Exception as e:
+            return {"status": "error", "message": f"Unreadable config.json in {repo_id}: {e}"}
 
         # Save model type marker for future inference
+        device = _select_device()
+        marker = {
+            "type": model_type,
+            "quantized": True,
+            "device": device,
+            "dtype": _preferred_dtype_name(device, dest_path),
+        }
+        if model_type == "causal" and request.get("quant") == "nf4":
+            # Used only where bitsandbytes and CUDA are available
+            marker["quant"] = "nf4"
         with open(os.path.join(dest_path, "ghostedit_model_type.json"), "w") as f:
-            json.dump({"type": model_type}, f)
+            json.dump(marker, f)
+
+        # ONNX export is optional -- inference falls back to PyTorch without it.
+        # The export is only ever loaded on CPU, and causal exports (with their
+        # KV-cache graphs) are large and slow, so those are opt-in
+        if device == "cpu" and (model_type == "seq2seq" or request.get("onnx", False)):
+            progress_callback("Exporting ONNX model...", 85)
+            try:
+                _export_onnx(dest_path, model_type)
+            except ImportError:
+                progress_callback("ONNX export skipped (optimum/onnxruntime not installed)", 90)
+            except Exception as e:
+                progress_callback(f"ONNX export skipped: {e}", 90)
+
+        # The traced encoder is only used on CPU with quantize=false, which the
+        # app does not send by default, so tracing (a full model load) is opt-in
+        if model_type == "seq2seq" and device == "cpu" and request.get("trace_encoder", False):
+            progress_callback("Tracing encoder...", 95)
+            try:
+                _trace_encoder(dest_path)
+            except Exception as e:
+                progress_callback(f"Encoder tracing skipped: {e}", 98)
 
         progress_callback("Download complete", 100)
         return {"status": "ok", "model_path": dest_path, "model_type": model_type}
@@ -196,41 +1007,37 @@ def cmd_download(request):
         return {"status": "error", "message": str(e)}
 
 
+def _is_installed(pkg):
+    """Check whether a package is importable without executing its import."""
+    try:
+        return importlib.util.find_spec(pkg) is not None
+    except (ImportError, ValueError):
+        return False
+
+
 def cmd_check_packages(_request):
     """Check which required Python packages are installed."""
     required = ["transformers", "torch", "huggingface_hub"]
+    # Optional accelerators: reported separately so they never block setup
+    optional = ["hf_transfer", "orjson"]
     installed = []
     missing = []
+    optional_missing = []
 
-    for pkg in required:
-        try:
-            __import__(pkg)
+    for pkg in required + optional:
+        if _is_installed(pkg):
             installed.append(pkg)
-        except ImportError:
+        elif pkg in required:
             missing.append(pkg)
+        else:
+            optional_missing.append(pkg)
 
-    return {"status": "ok", "installed": installed, "missing": missing}
+    return {"status": "ok", "installed": installed, "missing": missing, "optional_missing": optional_missing}
 
 
 def cmd_check_hf_login(_request):
     """Check HuggingFace login status."""
-    env_token = os.environ.get("HF_TOKEN", "")
-
-    token = None
-    source = "none"
-    if env_token:
-        token = env_token
-        source = "env"
-    else:
-        for path in ["~/.cache/huggingface/token", "~/.huggingface/token"]:
-            expanded = os.path.expanduser(path)
-            if os.path.isfile(expanded):
-                with open(expanded) as f:
-                    t = f.read().strip()
-                if t:
-                    token = t
-                    source = "file"
-                    break
+    token, source = _resolve_token()
 
     if not token:
         return {"status": "ok", "logged_in": False, "username": "", "token_source": "none"}
@@ -274,60 +1081,274 @@ def cmd_save_hf_token(request):
 
 def cmd_logout_hf(_request):
     """Remove HuggingFace token files from both standard and legacy locations."""
-    for path in ["~/.cache/huggingface/token", "~/.huggingface/token"]:
+    for path in HF_TOKEN_PATHS:
         expanded = os.path.expanduser(path)
         if os.path.isfile(expanded):
             os.remove(expanded)
     return {"status": "ok"}
 
 
-def serve():
-    """Persistent serve mode -- reads line-delimited JSON requests from stdin."""
-    cached_model = None
-    cached_tokenizer = None
-    cached_model_path = None
-    cached_model_type = None
+MODEL_CACHE_SIZE = 2
+COMPILE_WARMUP_TOKENS = 16
+
+
+def _torch_version():
+    """Return the installed torch (major, minor) version."""
+    import torch
+
+    parts = torch.__version__.split("+")[0].split(".")
+    try:
+        return int(parts[0]), int(parts[1])
+    except (IndexError, ValueError):
+        return 0, 0
+
+
+def _compile_model(model, tokenizer, model_type):
+    """Compile model.forward with TorchInductor and warm it up with a dummy generate().
+
+    Only applies to PyTorch modules on torch >= 2.1 outside Metal. If compiling
+    or the warm-up fails, the eager forward is restored.
+    """
+    import torch
+
+    if not isinstance(model, torch.nn.Module) or _torch_version() < (2, 1):
+        return model
+    if model.device.type == "mps":
+        return model
+
+    eager_forward = model.forward
+    try:
+        model.forward = torch.compile(eager_forward, mode="reduce-overhead", dynamic=True)
+        warmup = torch.ones((1, COMPILE_WARMUP_TOKENS), dtype=torch.long, device=model.device)
+        with torch.no_grad():
+            model.generate(
+                input_ids=warmup,
+                attention_mask=torch.ones_like(warmup),
+                max_new_tokens=4,
+                **_generation_kwargs(tokenizer),
+            )
+    except Exception:
+        model.forward = eager_forward
+    return model
+
+
+def _empty_device_cache(device_type):
+    """Return memory freed by an evicted model to the OS on Metal or CUDA.
+
+    gc.collect() only releases tensors back to torch's caching allocator.
+    """
+    if device_type not in ("mps", "cuda"):
+        return
+    import torch
 
-    for line in sys.stdin:
-        line = line.strip()
-        if not line:
+    try:
+        if device_type == "mps":
+            torch.mps.empty_cache()
+        else:
+            torch.cuda.empty_cache()
+    except (AttributeError, RuntimeError):
+        pass
+
+
+def _get_cached_model(cache, model_path, quantize, compile_model=False):
+    """Return (tokenizer, model, model_type) from an LRU cache, loading on a miss.
+
+    With compile_model, newly loaded models are compiled once before caching.
+    """
+    # Quantization is part of the key so the INT8 conversion is paid once per
+    # model; it is normalised to what _load_model would actually do, so devices
+    # that ignore quantize never cache two identical copies
+    marker = _read_model_marker(model_path)
+    model_type = _detect_model_type(model_path, marker)
+    quantize = _quantization_mode(marker, model_type, _select_device(), quantize) is not None
+    key = (model_path, quantize)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    # Evict before loading so a new model never shares memory with the one it replaces
+    while cache and len(cache) >= MODEL_CACHE_SIZE:
+        _, (_, evicted, _) = cache.popitem(last=False)
+        device_type = str(getattr(evicted, "device", "cpu")).split(":")[0]
+        del evicted
+        gc.collect()
+        _empty_device_cache(device_type)
+
+    tokenizer = _transformers().AutoTokenizer.from_pretrained(model_path)
+    model, model_type = _load_model(model_path, quantize=quantize)
+    if compile_model:
+        model = _compile_model(model, tokenizer, model_type)
+    cache[key] = (tokenizer, model, model_type)
+    return cache[key]
+
+
+MAX_BATCH_SIZE = 16
+BATCH_WAIT_SECONDS = 0.005
+
+
+def _read_request_lines(fd, pending, max_lines):
+    """Block until at least one line is available on fd, then drain queued lines.
+
+    pending is a bytearray carrying partial lines between calls. Returns
+    (lines, eof); after the first line only data arriving within
+    BATCH_WAIT_SECONDS is collected, up to max_lines.
+    """
+    lines = []
+    while len(lines) < max_lines:
+        newline = pending.find(b"\n")
+        if newline >= 0:
+            lines.append(bytes(pending[:newline]))
+            del pending[:newline + 1]
             continue
+
+        timeout = BATCH_WAIT_SECONDS if lines else None
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if not ready:
+            break
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            if pending:
+                lines.append(bytes(pending))
+                pending.clear()
+            return lines, True
+        pending.extend(chunk)
+    return lines, False
+
+
+def _infer_batch_key(request):
+    """Infer requests with the same key can share one generate() call."""
+    return (
+        request.get("model_path", ""),
+        request.get("quantize", True),
+        request.get("max_length", 256),
+        request.get("no_repeat_ngram_size", 0),
+    )
+
+
+def _handle_command(request):
+    """Dispatch a non-infer serve command."""
+    command = request.get("command", "")
+    if command == "ping":
+        return {"status": "ok"}
+    handler = {
+        "download": cmd_download,
+        "check_packages": cmd_check_packages,
+        "check_hf_login": cmd_check_hf_login,
+        "save_hf_token": cmd_save_hf_token,
+        "logout_hf": cmd_logout_hf,
+    }.get(command)
+    return handler(request) if handler else {"status": "error", "message": f"Unknown command: {command}"}
+
+
+def _json_loads(data):
+    """Parse a JSON request line (bytes), using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    """Serialize a response to UTF-8 JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
         try:
-            request = json.loads(line)
-        except json.JSONDecodeError as e:
-            print(json.dumps({"status": "error", "message": f"Invalid JSON: {e}"}), flush=True)
-            continue
+            return orjson.dumps(obj)
+        except TypeError:
+            # e.g. integers wider than 64 bits; the stdlib handles these
+            pass
+    return json.dumps(obj).encode("utf-8")
 
-        command = request.get("command", "")
-
-        if command == "infer":
-            model_path = request.get("model_path", "")
-            if model_path != cached_model_path:
-                try:
-                    from transformers import AutoTokenizer
-                    cached_tokenizer = AutoTokenizer.from_pretrained(model_path)
-                    cached_model, cached_model_type = _load_model(model_path)
-                    cached_model_path = model_path
-                except Exception as e:
-                    print(json.dumps({"status": "error", "message": str(e)}), flush=True)
-                    continue
-            result = cmd_infer_with_cache(request, cached_tokenizer, cached_model, cached_model_type)
-        elif command == "ping":
-            result = {"status": "ok"}
-        else:
-            handler = {
-                "download": cmd_download,
-                "check_packages": cmd_check_packages,
-                "check_hf_login": cmd_check_hf_login,
-                "save_hf_token": cmd_save_hf_token,
-                "logout_hf": cmd_logout_hf,
-            }.get(command)
-            result = handler(request) if handler else {"status": "error", "message": f"Unknown command: {command}"}
 
-        print(json.dumps(result), flush=True)
+def _write_response(result, request=None):
+    """Write one response line, echoing the request id when the caller sent one."""
+    if isinstance(request, dict) and "id" in request:
+        result["id"] = request["id"]
+    sys.stdout.buffer.write(_json_dumps(result) + b"\n")
+    sys.stdout.buffer.flush()
+
+
+def serve(preload_path=None, compile_models=False):
+    """Persistent serve mode -- reads line-delimited JSON requests from stdin.
+
+    Keeps the most recently used models in memory. If preload_path is given the
+    model is loaded before the first request arrives; with compile_models,
+    models are compiled with torch.compile when they are first loaded.
+    Consecutive infer requests already queued on stdin for the same model are
+    run as one padded batch; responses are always written in request order.
+    """
+    _configure_cpu_threads()
+    model_cache = OrderedDict()
+    if preload_path:
+        try:
+            _get_cached_model(model_cache, preload_path, True, compile_models)
+        except Exception:
+            # Surface the error on the first infer request instead
+            pass
+
+    input_buffers = None
+    stdin_fd = sys.stdin.fileno()
+    pending = bytearray()
+    eof = False
+    while not eof:
+        lines, eof = _read_request_lines(stdin_fd, pending, MAX_BATCH_SIZE)
+
+        requests = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                requests.append(_json_loads(line))
+            except ValueError as e:
+                requests.append(ValueError(f"Invalid JSON: {e}"))
+
+        index = 0
+        while index < len(requests):
+            request = requests[index]
+            if isinstance(request, ValueError):
+                _write_response({"status": "error", "message": str(request)})
+                index += 1
+                continue
+
+            if request.get("command", "") != "infer":
+                _write_response(_handle_command(request), request)
+                index += 1
+                continue
+
+            # Group the run of queued infer requests that can share a batch;
+            # streaming requests always run alone so partials stay attributable
+            key = _infer_batch_key(request)
+            end = index + 1
+            while (
+                not request.get("stream", False)
+                and end < len(requests)
+                and isinstance(requests[end], dict)
+                and requests[end].get("command", "") == "infer"
+                and _infer_batch_key(requests[end]) == key
+                and not requests[end].get("stream", False)
+            ):
+                end += 1
+            group = requests[index:end]
+            index = end
+
+            model_path, quantize = key[0], key[1]
+            try:
+                tokenizer, model, model_type = _get_cached_model(
+                    model_cache, model_path, quantize, compile_models
+                )
+            except Exception as e:
+                for grouped in group:
+                    _write_response({"status": "error", "message": str(e)}, grouped)
+                continue
+
+            if input_buffers is None:
+                input_buffers = _make_input_buffers()
+            results = cmd_infer_batch_with_cache(group, tokenizer, model, model_type, input_buffers)
+            for grouped, result in zip(group, results):
+                _write_response(result, grouped)
 
 
 def main():
+    _configure_cpu_threads()
     raw = sys.stdin.read().strip()
     if not raw:
         print(json.dumps({"status": "error", "message": "Empty input"}))
@@ -361,6 +1382,10 @@ def main():
 
 if __name__ == "__main__":
     if "--serve" in sys.argv:
-        serve()
+        preload = None
+        if "--preload" in sys.argv:
+            index = sys.argv.index("--preload") + 1
+            preload = sys.argv[index] if index < len(sys.argv) else None
+        serve(preload_path=preload, compile_models="--compile" in sys.argv)
     else:
         main()
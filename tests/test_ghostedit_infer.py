@@ -0,0 +1,450 @@
+"""Unit tests for GhostEdit/Resources/ghostedit_infer.py.
+
+Run with: python -m unittest discover -s tests
+These cover the pure-Python helpers and need neither torch nor transformers.
+"""
+
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+SCRIPT_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "GhostEdit", "Resources", "ghostedit_infer.py",
+)
+
+sys.dont_write_bytecode = True
+_spec = importlib.util.spec_from_file_location("ghostedit_infer", SCRIPT_PATH)
+infer = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(infer)
+
+
+def _pipe_with(data, close=True):
+    """Return the read end of a pipe pre-filled with data (write end closed if close)."""
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, data)
+    if close:
+        os.close(write_fd)
+        return read_fd, None
+    return read_fd, write_fd
+
+
+class ReadRequestLinesTests(unittest.TestCase):
+    def setUp(self):
+        self.fds = []
+
+    def tearDown(self):
+        for fd in self.fds:
+            os.close(fd)
+
+    def _pipe(self, data, close=True):
+        read_fd, write_fd = _pipe_with(data, close)
+        self.fds.append(read_fd)
+        if write_fd is not None:
+            self.fds.append(write_fd)
+        return read_fd
+
+    def test_drains_all_queued_lines(self):
+        fd = self._pipe(b'{"a": 1}\n{"b": 2}\n', close=False)
+        pending = bytearray()
+        lines, eof = infer._read_request_lines(fd, pending, 16)
+        self.assertEqual(lines, [b'{"a": 1}', b'{"b": 2}'])
+        self.assertFalse(eof)
+        self.assertEqual(pending, b"")
+
+    def test_keeps_partial_line_for_next_call(self):
+        fd = self._pipe(b"first\nsec", close=False)
+        pending = bytearray()
+        lines, eof = infer._read_request_lines(fd, pending, 16)
+        self.assertEqual(lines, [b"first"])
+        self.assertFalse(eof)
+        self.assertEqual(pending, b"sec")
+
+        os.write(self.fds[-1], b"ond\n")
+        lines, eof = infer._read_request_lines(fd, pending, 16)
+        self.assertEqual(lines, [b"second"])
+        self.assertFalse(eof)
+
+    def test_eof_flushes_trailing_line_without_newline(self):
+        fd = self._pipe(b"one\ntwo")
+        pending = bytearray()
+        lines, eof = infer._read_request_lines(fd, pending, 16)
+        self.assertEqual(lines, [b"one", b"two"])
+        self.assertTrue(eof)
+        self.assertEqual(pending, b"")
+
+    def test_eof_on_empty_input(self):
+        fd = self._pipe(b"")
+        lines, eof = infer._read_request_lines(fd, bytearray(), 16)
+        self.assertEqual(lines, [])
+        self.assertTrue(eof)
+
+    def test_stops_at_max_lines(self):
+        fd = self._pipe(b"1\n2\n3\n")
+        pending = bytearray()
+        lines, eof = infer._read_request_lines(fd, pending, 2)
+        self.assertEqual(lines, [b"1", b"2"])
+        self.assertFalse(eof)
+
+        lines, eof = infer._read_request_lines(fd, pending, 2)
+        self.assertEqual(lines, [b"3"])
+        self.assertTrue(eof)
+
+
+class ServeTests(unittest.TestCase):
+    def _serve(self, requests):
+        """Run serve() over the given request lines; return (responses, batches)."""
+        data = b"".join(
+            (line if isinstance(line, bytes) else json.dumps(line).encode()) + b"\n"
+            for line in requests
+        )
+        read_fd, _ = _pipe_with(data)
+        stdin = mock.Mock()
+        stdin.fileno.return_value = read_fd
+        stdout = mock.Mock()
+        stdout.buffer = io.BytesIO()
+        batches = []
+
+        def fake_batch(group, tokenizer, model, model_type, buffers=None):
+            batches.append([request["id"] for request in group])
+            return [{"status": "ok", "corrected": request["text"].upper()} for request in group]
+
+        def fake_cached_model(cache, model_path, quantize, compile_model=False):
+            if model_path == "missing":
+                raise FileNotFoundError("no model")
+            return "tokenizer", "model", "seq2seq"
+
+        try:
+            with mock.patch.object(sys, "stdin", stdin), \
+                    mock.patch.object(sys, "stdout", stdout), \
+                    mock.patch.object(infer, "_configure_cpu_threads"), \
+                    mock.patch.object(infer, "_make_input_buffers", return_value={}), \
+                    mock.patch.object(infer, "_get_cached_model", side_effect=fake_cached_model), \
+                    mock.patch.object(infer, "cmd_infer_batch_with_cache", side_effect=fake_batch):
+                infer.serve()
+        finally:
+            os.close(read_fd)
+        responses = [json.loads(line) for line in stdout.buffer.getvalue().splitlines()]
+        return responses, batches
+
+    @staticmethod
+    def _infer(request_id, text, **extra):
+        request = {"command": "infer", "id": request_id, "model_path": "m", "text": text}
+        request.update(extra)
+        return request
+
+    def test_batches_consecutive_compatible_requests(self):
+        responses, batches = self._serve([
+            self._infer(1, "a"),
+            self._infer(2, "b"),
+            self._infer(3, "c"),
+        ])
+        self.assertEqual(batches, [[1, 2, 3]])
+        self.assertEqual([r["id"] for r in responses], [1, 2, 3])
+        self.assertEqual([r["corrected"] for r in responses], ["A", "B", "C"])
+
+    def test_splits_on_different_batch_key(self):
+        _, batches = self._serve([
+            self._infer(1, "a"),
+            self._infer(2, "b", max_length=64),
+            self._infer(3, "c", max_length=64),
+            self._infer(4, "d"),
+        ])
+        self.assertEqual(batches, [[1], [2, 3], [4]])
+
+    def test_streaming_requests_run_alone(self):
+        _, batches = self._serve([
+            self._infer(1, "a", stream=True),
+            self._infer(2, "b"),
+            self._infer(3, "c", stream=True),
+            self._infer(4, "d"),
+        ])
+        self.assertEqual(batches, [[1], [2], [3], [4]])
+
+    def test_preserves_order_across_other_commands(self):
+        responses, batches = self._serve([
+            self._infer(1, "a"),
+            {"command": "ping", "id": 2},
+            b"not json",
+            self._infer(4, "d"),
+        ])
+        self.assertEqual(batches, [[1], [4]])
+        self.assertEqual(responses[0], {"status": "ok", "corrected": "A", "id": 1})
+        self.assertEqual(responses[1], {"status": "ok", "id": 2})
+        self.assertEqual(responses[2]["status"], "error")
+        self.assertNotIn("id", responses[2])
+        self.assertEqual(responses[3]["id"], 4)
+
+    def test_load_error_is_reported_for_every_grouped_request(self):
+        responses, batches = self._serve([
+            self._infer(1, "a", model_path="missing"),
+            self._infer(2, "b", model_path="missing"),
+            self._infer(3, "c"),
+        ])
+        self.assertEqual(batches, [[3]])
+        self.assertEqual([r["id"] for r in responses], [1, 2, 3])
+        self.assertEqual([r["status"] for r in responses], ["error", "error", "ok"])
+        self.assertEqual(responses[0]["message"], "no model")
+
+
+class InferBatchTests(unittest.TestCase):
+    def _run(self, requests):
+        def fake_batch(tokenizer, model, model_type, prompts, max_length, no_repeat_ngram_size=0):
+            return [prompt.upper() for prompt in prompts]
+
+        with mock.patch.object(infer, "_run_batch_inference", side_effect=fake_batch):
+            return infer.cmd_infer_batch_with_cache(requests, "tokenizer", "model", "seq2seq")
+
+    def test_malformed_request_fails_alone(self):
+        results = self._run([
+            {"text": 5},
+            {"text": "ok"},
+            {"text": "fine", "prompt_template": 7},
+            {"text": "also"},
+        ])
+        self.assertEqual([r["status"] for r in results], ["error", "ok", "error", "ok"])
+        self.assertEqual(results[1]["corrected"], "OK")
+        self.assertEqual(results[3]["corrected"], "ALSO")
+
+    def test_missing_text_is_reported(self):
+        results = self._run([{"text": ""}, {"text": "a"}, {"text": "b"}])
+        self.assertEqual(results[0], {"status": "error", "message": "text is required"})
+        self.assertEqual([r["corrected"] for r in results[1:]], ["A", "B"])
+
+
+class ModelCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.cache_sizes = []
+        self.device = "cpu"
+        transformers = mock.Mock()
+        transformers.AutoTokenizer.from_pretrained.side_effect = lambda path: "tok-" + path
+        patches = [
+            mock.patch.object(infer, "_transformers", return_value=transformers),
+            mock.patch.object(infer, "_load_model", side_effect=self._fake_load),
+            mock.patch.object(infer, "_select_device", side_effect=lambda: self.device),
+            mock.patch.object(infer, "_read_model_marker", return_value={"type": "seq2seq"}),
+            mock.patch.object(infer, "_empty_device_cache"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.cache = infer.OrderedDict()
+
+    def _fake_load(self, model_path, quantize=True):
+        self.cache_sizes.append(len(self.cache))
+        self.loaded.append((model_path, quantize))
+        return mock.Mock(device=self.device), "seq2seq"
+
+    def test_evicts_before_loading(self):
+        for path in ("a", "b", "c"):
+            infer._get_cached_model(self.cache, path, True)
+        self.assertEqual(self.cache_sizes, [0, 1, 1])
+        self.assertEqual(list(self.cache), [("b", True), ("c", True)])
+
+    def test_hit_refreshes_lru_order(self):
+        infer._get_cached_model(self.cache, "a", True)
+        infer._get_cached_model(self.cache, "b", True)
+        infer._get_cached_model(self.cache, "a", True)
+        infer._get_cached_model(self.cache, "c", True)
+        self.assertEqual(list(self.cache), [("a", True), ("c", True)])
+        self.assertEqual(len(self.loaded), 3)
+
+    def test_eviction_empties_device_cache(self):
+        self.device = "mps"
+        for path in ("a", "b", "c"):
+            infer._get_cached_model(self.cache, path, True)
+        infer._empty_device_cache.assert_called_once_with("mps")
+
+    def test_quantize_flag_ignored_where_it_has_no_effect(self):
+        self.device = "mps"
+        infer._get_cached_model(self.cache, "a", True)
+        infer._get_cached_model(self.cache, "a", False)
+        self.assertEqual(self.loaded, [("a", False)])
+
+    def test_quantize_flag_keys_cpu_models(self):
+        infer._get_cached_model(self.cache, "a", True)
+        infer._get_cached_model(self.cache, "a", False)
+        self.assertEqual(self.loaded, [("a", True), ("a", False)])
+
+
+class _Array2D:
+    """Minimal (batch, length) array supporting a[b, k] and .shape, standing in for numpy."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.shape = (len(rows), len(rows[0]))
+
+    def __getitem__(self, index):
+        b, k = index
+        return self.rows[b][k]
+
+
+class BannedNgramTokensTests(unittest.TestCase):
+    def _banned(self, rows, n, start=0):
+        input_ids = _Array2D(rows)
+        capacity = input_ids.shape[0] * input_ids.shape[1]
+        banned_rows, banned_tokens = [0] * capacity, [0] * capacity
+        count = infer._banned_ngram_tokens(input_ids, start, n, banned_rows, banned_tokens)
+        return list(zip(banned_rows[:count], banned_tokens[:count]))
+
+    def test_bans_token_completing_repeated_ngram(self):
+        self.assertEqual(self._banned([[1, 2, 3, 1, 2]], 3), [(0, 3)])
+
+    def test_reports_every_earlier_continuation(self):
+        self.assertEqual(self._banned([[5, 7, 5, 8, 5]], 2), [(0, 7), (0, 8)])
+
+    def test_no_ban_without_repeat(self):
+        self.assertEqual(self._banned([[1, 2, 3, 4, 5]], 2), [])
+
+    def test_rows_are_checked_independently(self):
+        self.assertEqual(self._banned([[1, 2, 1], [3, 4, 4]], 2), [(0, 2), (1, 4)])
+
+    def test_prompt_tokens_before_start_are_ignored(self):
+        self.assertEqual(self._banned([[1, 2, 3, 1, 2]], 3, start=1), [])
+        self.assertEqual(self._banned([[9, 1, 2, 1]], 2, start=1), [(0, 2)])
+
+    def test_sequence_shorter_than_ngram(self):
+        self.assertEqual(self._banned([[1, 2]], 4), [])
+        self.assertEqual(self._banned([[1, 2, 3]], 3, start=2), [])
+
+    def test_unigram_bans_every_generated_token(self):
+        self.assertEqual(self._banned([[4, 6]], 1), [(0, 4), (0, 6)])
+
+
+class EnableParallelDownloadsTests(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.dict(os.environ),
+            mock.patch.dict(sys.modules),
+            mock.patch.object(infer.importlib.util, "find_spec", return_value=object()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        os.environ.pop("HF_HUB_ENABLE_HF_TRANSFER", None)
+        sys.modules.pop("huggingface_hub", None)
+
+    def test_enabled_by_default(self):
+        self.assertTrue(infer._enable_parallel_downloads())
+        self.assertEqual(os.environ["HF_HUB_ENABLE_HF_TRANSFER"], "1")
+
+    def test_accepts_huggingface_hub_true_values(self):
+        for value in ("true", "YES", "on"):
+            os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = value
+            self.assertTrue(infer._enable_parallel_downloads(), value)
+
+    def test_respects_user_opt_out(self):
+        os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "0"
+        self.assertFalse(infer._enable_parallel_downloads())
+
+    def test_not_reported_after_huggingface_hub_import(self):
+        sys.modules["huggingface_hub"] = mock.Mock()
+        self.assertFalse(infer._enable_parallel_downloads())
+
+    def test_disabled_without_hf_transfer(self):
+        infer.importlib.util.find_spec.return_value = None
+        self.assertFalse(infer._enable_parallel_downloads())
+        self.assertNotIn("HF_HUB_ENABLE_HF_TRANSFER", os.environ)
+
+
+class SelectDownloadFilesTests(unittest.TestCase):
+    def test_prefers_safetensors_over_other_formats(self):
+        files = infer._select_download_files([
+            "config.json", "generation_config.json", "spiece.model", "tokenizer.json",
+            "model.safetensors", "pytorch_model.bin", "tf_model.h5", "flax_model.msgpack",
+            "rust_model.ot", "onnx/encoder_model.onnx", "onnx/config.json", "README.md",
+        ])
+        self.assertEqual(sorted(files), [
+            "config.json", "generation_config.json", "model.safetensors", "spiece.model", "tokenizer.json",
+        ])
+
+    def test_skips_consolidated_and_original_checkpoints(self):
+        files = infer._select_download_files([
+            "config.json", "params.json", "tokenizer.model", "tokenizer_config.json",
+            "consolidated.safetensors", "original/consolidated.00.pth", "original/params.json",
+            "model-00001-of-00002.safetensors", "model-00002-of-00002.safetensors",
+            "model.safetensors.index.json",
+        ])
+        self.assertEqual(sorted(files), [
+            "config.json", "model-00001-of-00002.safetensors", "model-00002-of-00002.safetensors",
+            "model.safetensors.index.json", "params.json", "tokenizer.model", "tokenizer_config.json",
+        ])
+
+    def test_skips_gguf_and_other_checkpoint_files(self):
+        files = infer._select_download_files([
+            "config.json", "tokenizer.json", "gemma-2b.gguf", "model.ckpt", "encoder.pt",
+            "model.safetensors",
+        ])
+        self.assertEqual(sorted(files), ["config.json", "model.safetensors", "tokenizer.json"])
+
+    def test_falls_back_to_pytorch_bin(self):
+        files = infer._select_download_files([
+            "config.json", "vocab.txt", "merges.txt", "pytorch_model.bin", "training_args.bin",
+            "consolidated.safetensors",
+        ])
+        self.assertEqual(sorted(files), ["config.json", "merges.txt", "pytorch_model.bin", "vocab.txt"])
+
+    def test_none_without_loadable_weights(self):
+        self.assertIsNone(infer._select_download_files(["config.json", "model.gguf", "tf_model.h5"]))
+
+
+class ResolveTokenTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.paths = [os.path.join(self.tmp.name, "primary"), os.path.join(self.tmp.name, "legacy")]
+        patches = [
+            mock.patch.object(infer, "HF_TOKEN_PATHS", self.paths),
+            mock.patch.object(infer, "_token_cache", {"signature": None, "token": None}),
+            mock.patch.dict(os.environ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        os.environ.pop("HF_TOKEN", None)
+
+    def _write(self, path, contents, mtime):
+        with open(path, "w") as f:
+            f.write(contents)
+        os.utime(path, (mtime, mtime))
+
+    def test_no_token(self):
+        self.assertEqual(infer._resolve_token(), (None, "none"))
+
+    def test_env_takes_precedence(self):
+        self._write(self.paths[0], "hf_file", 1000)
+        os.environ["HF_TOKEN"] = "hf_env"
+        self.assertEqual(infer._resolve_token(), ("hf_env", "env"))
+
+    def test_falls_back_to_legacy_path(self):
+        self._write(self.paths[1], "hf_legacy\n", 1000)
+        self.assertEqual(infer._resolve_token(), ("hf_legacy", "file"))
+
+    def test_unchanged_files_are_not_reread(self):
+        self._write(self.paths[0], "hf_one", 1000)
+        self.assertEqual(infer._resolve_token(), ("hf_one", "file"))
+        with mock.patch("builtins.open", side_effect=AssertionError("token file re-read")):
+            self.assertEqual(infer._resolve_token(), ("hf_one", "file"))
+
+    def test_cache_invalidated_when_file_changes(self):
+        self._write(self.paths[0], "hf_one", 1000)
+        self.assertEqual(infer._resolve_token(), ("hf_one", "file"))
+        self._write(self.paths[0], "hf_two", 2000)
+        self.assertEqual(infer._resolve_token(), ("hf_two", "file"))
+
+    def test_cache_invalidated_when_file_created_or_removed(self):
+        self.assertEqual(infer._resolve_token(), (None, "none"))
+        self._write(self.paths[0], "hf_new", 1000)
+        self.assertEqual(infer._resolve_token(), ("hf_new", "file"))
+        os.remove(self.paths[0])
+        self.assertEqual(infer._resolve_token(), (None, "none"))
+
+
+if __name__ == "__main__":
+    unittest.main()